@@ -3,7 +3,7 @@
 """
 リポジトリの src/ 構造から structure (YAML 文字列) を生成し、
 主要概念ごとに:
-  1) structure を LLM に渡して関連ファイルパスを JSON 配列で抽出
+  1) structure を LLM に渡して関連ファイルパスを JSON で抽出
   2) 該当ファイルを収集・整形して related_codes を作成
   3) related_codes + 概念 を LLM に渡して、誰でもわかる説明の Markdown を生成
   4) .docs/<slug>.md として保存し、mdBook 用の SUMMARY を自動生成
@@ -17,22 +17,44 @@
 - SRC_DIR: 解析対象ディレクトリ (default: src)
 - CONCEPTS_FILE: 概念リストファイル (default: .docs/concepts.yaml)
 - OUTPUT_DIR: 出力ディレクトリ (default: .docs)
-- MAX_CONTEXT_CHARS: related_codes の最大文字数 (default: 120000)
+- REPO_BASE_URL: 根拠リンクに使う GitHub 上のベース URL (default: https://github.com/netmateapp/netmate-api/tree/main/)
+- MAX_CONTEXT_TOKENS: related_codes の最大トークン数 (default: OAI_MODEL_DOCS のコンテキスト長から算出)
+- OAI_CONCURRENCY: OpenAI API への同時リクエスト数の上限 (default: 8)
+- OAI_RPM: 1 分あたりのリクエスト数の上限 (default: 500)
+- OAI_TPM: 1 分あたりのトークン数の上限 (default: 200000)
+- OAI_MAX_ATTEMPTS: 429 / 5xx 時の最大試行回数 (default: 5)
+- OAI_CACHE: 0 で LLM 応答のディスクキャッシュを無効化 (default: 1)
+- OAI_JSON_MODE: 0 でファイル抽出時の response_format (JSON モード) を使わない (default: 1)
+- OAI_STREAM: 0 で応答をストリーミング (SSE) で受け取らない (default: 1)
+- OAI_BATCH_POLL_SECONDS: --batch 時に Batch の状態を確認する間隔 (秒) (default: 60)
+
+オプション:
+- --no-cache: LLM 応答のディスクキャッシュを使わない (OAI_CACHE=0 と同じ)。入力が前回と同じでも再生成する
+- --batch: related_codes の圧縮とドキュメント生成を Batch API でまとめて行う。結果は最大 24 時間後になるため夜間実行向け
 """
 
 from __future__ import annotations
+import io
 import os
 import re
+import asyncio
 import sys
+import stat
 import json
 import glob
+import argparse
 import yaml
 import time
-import pathlib
+import random
 import textwrap
 import typing as t
 import hashlib
-import requests
+import threading
+import unicodedata
+import functools
+import httpx
+import orjson
+import tiktoken
 
 # ------------------ 設定 ------------------
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
@@ -46,7 +68,38 @@ MODEL_DOCS = os.environ.get("OAI_MODEL_DOCS", "gpt-4o-mini")
 SRC_DIR = os.environ.get("SRC_DIR", "src")
 CONCEPTS_FILE = os.environ.get("CONCEPTS_FILE", ".docs/concepts.yaml")
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", ".docs")
-MAX_CONTEXT_CHARS = int(os.environ.get("MAX_CONTEXT_CHARS", "120000"))
+REPO_BASE_URL = os.environ.get("REPO_BASE_URL", "https://github.com/netmateapp/netmate-api/tree/main/")
+# 0 ならドキュメント生成モデルのコンテキスト長から main() で算出する
+MAX_CONTEXT_TOKENS = int(os.environ.get("MAX_CONTEXT_TOKENS", "0"))
+OAI_CONCURRENCY = int(os.environ.get("OAI_CONCURRENCY", "8"))
+OAI_RPM = float(os.environ.get("OAI_RPM", "500"))
+OAI_TPM = float(os.environ.get("OAI_TPM", "200000"))
+OAI_MAX_ATTEMPTS = max(1, int(os.environ.get("OAI_MAX_ATTEMPTS", "5")))
+CACHE_ENABLED = os.environ.get("OAI_CACHE", "1") != "0"
+JSON_MODE = os.environ.get("OAI_JSON_MODE", "1") != "0"
+STREAM_ENABLED = os.environ.get("OAI_STREAM", "1") != "0"
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+# プロンプトや応答の扱いを変えたら上げる（古いキャッシュを無効化するため）
+CACHE_VERSION = 2
+# これより高い temperature の応答は毎回変わるべきものとしてキャッシュしない
+CACHE_MAX_TEMPERATURE = 0.3
+# 要約を連結しても MAX_CONTEXT_TOKENS に収まらないときに、要約をさらに要約する最大段数
+COMPRESS_MAX_ROUNDS = 3
+OAI_BATCH_POLL_SECONDS = float(os.environ.get("OAI_BATCH_POLL_SECONDS", "60"))
+
+# libyaml がリンクされていれば C 実装のローダーを使う
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# モデル名の接頭辞 -> (コンテキスト長, 最大出力トークン数)。最も長く一致する接頭辞を使う
+MODEL_LIMITS = {
+    "gpt-4o-mini": (128000, 16384),
+    "gpt-4o": (128000, 16384),
+    "gpt-4.1": (1047576, 32768),
+    "gpt-4-turbo": (128000, 4096),
+    "o3": (200000, 100000),
+    "o4-mini": (200000, 100000),
+}
+DEFAULT_MODEL_LIMITS = (128000, 16384)
 
 EXCLUDE_PATTERNS = [
     r"(^|/)tests?(/|$)", r"(^|/)__tests__(/|$)", r"(^|/)spec(s)?(/|$)",
@@ -54,15 +107,29 @@ EXCLUDE_PATTERNS = [
     r"(^|/)stories?(/|$)", r"\.story\.", r"\.spec\.", r"\.test\.",
     r"(^|/)scripts?(/|$)", r"(^|/)bench(marks)?(/|$)", r"(^|/)examples?(/|$)",
     r"(^|/)docs?(/|$)", r"(^|/)\.docs(/|$)", r"(^|/)build(/|$)", r"(^|/)dist(/|$)",
+    # ビルド成果物・依存・VCS（巨大になりやすいので走査時に丸ごと枝刈りする）
+    r"(^|/)target(/|$)", r"(^|/)node_modules(/|$)", r"(^|/)\.git(/|$)",
+    r"(^|/)\.?venv(/|$)", r"(^|/)__pycache__(/|$)",
 ]
 EXCLUDE_RE = re.compile("|".join(EXCLUDE_PATTERNS), re.IGNORECASE)
+# EXCLUDE_PATTERNS のうちディレクトリ名だけで判定できるもの（正規表現の前の O(1) 判定用）
+EXCLUDE_DIR_NAMES = {
+    "test", "tests", "__tests__", "spec", "specs", "e2e", "fixture", "fixtures", "mock", "mocks",
+    "story", "stories", "script", "scripts", "bench", "benchmarks", "example", "examples",
+    "doc", "docs", ".docs", "build", "dist",
+    "target", "node_modules", ".git", "venv", ".venv", "__pycache__",
+}
 
-ALLOWED_CODE_EXTS = {
-    ".ts", ".tsx", ".js", ".jsx", ".mjs", ".cjs",
-    ".py", ".rb", ".go", ".rs", ".java", ".kt", ".kts", ".scala",
-    ".php", ".cs", ".cpp", ".c", ".hpp", ".h", ".swift",
-    ".sql", ".json", ".yml", ".yaml", ".toml", ".ini", ".env",
+# 対象とするコードの拡張子と、コードブロックの言語名
+EXT_TO_LANG = {
+    ".ts": "ts", ".tsx": "tsx", ".js": "js", ".jsx": "jsx", ".mjs": "js", ".cjs": "js",
+    ".py": "python", ".rb": "ruby", ".go": "go", ".rs": "rust", ".java": "java",
+    ".kt": "kotlin", ".kts": "kotlin", ".scala": "scala", ".php": "php", ".cs": "csharp",
+    ".cpp": "cpp", ".c": "c", ".hpp": "cpp", ".h": "c", ".swift": "swift", ".sql": "sql",
+    ".json": "json", ".yml": "yaml", ".yaml": "yaml", ".toml": "toml", ".ini": "ini", ".env": "bash",
 }
+# str.endswith にそのまま渡せる形（拡張子判定を 1 回の呼び出しで済ませる）
+CODE_SUFFIXES = tuple(EXT_TO_LANG)
 
 # -------------- ユーティリティ --------------
 
@@ -73,12 +140,45 @@ def slugify(text: str) -> str:
     return s or "concept"
 
 
+@functools.lru_cache(maxsize=1)
+def get_encoder() -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(MODEL_DOCS)
+    except KeyError:
+        # tiktoken が知らないモデル名の場合は gpt-4o 系のエンコーディングで数える
+        return tiktoken.get_encoding("o200k_base")
+
+
+# 本文の SHA-1 -> トークン数（同じファイルや related_codes を何度も数え直さないため）
+_TOKEN_COUNTS: dict[bytes, int] = {}
+
+
+def count_tokens(text: str) -> int:
+    key = hashlib.sha1(text.encode("utf-8", errors="replace")).digest()
+    n = _TOKEN_COUNTS.get(key)
+    if n is None:
+        # encode() はコード中の "<|endoftext|>" などで例外になるため特殊トークンを解釈しない版を使う
+        n = _TOKEN_COUNTS[key] = len(get_encoder().encode_ordinary(text))
+    return n
+
+
+def count_tokens_batch(texts: list[str]) -> list[int]:
+    """count_tokens の一括版。未計測のものだけを encode_ordinary_batch で 1 回にまとめて数える"""
+    keys = [hashlib.sha1(text.encode("utf-8", errors="replace")).digest() for text in texts]
+    missing = {key: text for key, text in zip(keys, texts) if key not in _TOKEN_COUNTS}
+    if missing:
+        encoded = get_encoder().encode_ordinary_batch(list(missing.values()), num_threads=os.cpu_count() or 1)
+        for key, ids in zip(missing, encoded):
+            _TOKEN_COUNTS[key] = len(ids)
+    return [_TOKEN_COUNTS[key] for key in keys]
+
+
 def read_concepts(path: str) -> tuple[str, list[str]]:
     if not os.path.exists(path):
         print(f"[WARN] 概念リスト {path} が見つかりません。スキップします。")
         return ("", [])
     with open(path, "r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
+        data = yaml.load(f, Loader=YAML_LOADER) or {}
     domain = data.get("domain", "")
     concepts = data.get("concepts", []) or []
     if not concepts:
@@ -86,96 +186,469 @@ def read_concepts(path: str) -> tuple[str, list[str]]:
     return (domain, list(concepts))
 
 
-def build_structure_yaml(src_dir: str) -> str:
-    """src ディレクトリ以下の完全なツリーを YAML 文字列として構築"""
-    base = pathlib.Path(src_dir)
-    if not base.exists():
+_YAML_PLAIN_KEY_RE = re.compile(r"[A-Za-z_][\w.\-]*", re.ASCII)
+_YAML_RESERVED_WORDS = {"null", "true", "false", "yes", "no", "on", "off", "y", "n"}
+
+
+def yaml_key(name: str) -> str:
+    """ファイル名を YAML のマッピングキーとしてそのまま書ける形にする"""
+    if _YAML_PLAIN_KEY_RE.fullmatch(name) and name.lower() not in _YAML_RESERVED_WORDS:
+        return name
+    # JSON の文字列リテラルは YAML のダブルクォート文字列としても有効
+    return json.dumps(name, ensure_ascii=False)
+
+
+# (深さ, YAML キー, パス, ディレクトリか) の行きがけ順リスト
+TreeEntry = tuple[int, str, str, bool]
+
+
+def scan_tree(src_dir: str) -> list[TreeEntry]:
+    """src ディレクトリ以下を 1 回だけ走査し、名前順・行きがけ順の一覧にする（開発補助資産は除外）。
+    structure / 部分木 / フォールバック検索はすべてこの一覧を使い、src を再走査しない。
+    """
+    if not os.path.isdir(src_dir):
         print(f"[ERROR] {src_dir} が存在しません。", file=sys.stderr)
         sys.exit(1)
 
-    def tree(p: pathlib.Path):
-        if p.is_dir():
-            return {child.name: tree(child) for child in sorted(p.iterdir(), key=lambda x: x.name)}
+    root = src_dir.replace("\\", "/")
+    entries: list[TreeEntry] = [(0, yaml_key(os.path.basename(os.path.normpath(src_dir))), root, True)]
+
+    # 再帰せずスタックで辿る（深いツリーでも再帰上限に当たらない）。子は名前の逆順に積んで行きがけ順を保つ
+    stack: list[tuple[int, os.DirEntry]] = []
+
+    def push_children(path: str, depth: int):
+        with os.scandir(path) as it:
+            children = sorted(it, key=lambda e: e.name)
+        stack.extend((depth, entry) for entry in reversed(children))
+
+    push_children(src_dir, 1)
+    while stack:
+        depth, entry = stack.pop()
+        rel = entry.path.replace("\\", "/")
+        if entry.is_dir():
+            # シンボリックリンクのディレクトリは辿らない（循環を避ける）
+            if entry.is_symlink() or exclude_dev_dir(entry.name, rel):
+                continue
+            entries.append((depth, yaml_key(entry.name), rel, True))
+            push_children(entry.path, depth + 1)
+        elif not exclude_dev_asset(rel):
+            entries.append((depth, yaml_key(entry.name), rel, False))
+    return entries
+
+
+def render_structure_yaml(entries: list[TreeEntry]) -> str:
+    """scan_tree の結果（またはその部分集合）を YAML として書き出す。
+    ファイルは null、子を持たないディレクトリは空のマッピングとして表現する。
+    """
+    out = io.StringIO()
+    for i, (depth, key, _, is_dir) in enumerate(entries):
+        indent = "  " * depth
+        if not is_dir:
+            out.write(f"{indent}{key}: null\n")
+        elif i + 1 < len(entries) and entries[i + 1][0] > depth:
+            out.write(f"{indent}{key}:\n")
         else:
-            return None  # ファイルは None として表現
+            out.write(f"{indent}{key}: {{}}\n")
+    return out.getvalue()
+
+
+def fallback_key(concept: str) -> str:
+    """フォールバック検索でパスと突き合わせる概念のキー"""
+    return slugify(concept).replace("-", "").lower()
+
+
+def fallback_index(tree: list[TreeEntry], keys: t.Iterable[str]) -> dict[str, list[str]]:
+    """scan_tree の結果から、キーごとにそのキーをパスに含むファイルを集める"""
+    keys = tuple(k for k in dict.fromkeys(keys) if k)
+    index: dict[str, list[str]] = {k: [] for k in keys}
+    if not keys:
+        return index
+    # 各位置で最長一致するキーを拾う。そのキーに含まれる短いキーも同じ位置で一致している
+    alternation = "|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True))
+    pattern = re.compile(f"(?=({alternation}))")
+    contained = {k: [other for other in keys if other in k] for k in keys}
+    for _, _, path, is_dir in tree:
+        if is_dir:
+            continue
+        hits: set[str] = set()
+        for m in pattern.finditer(path.lower()):
+            hits.update(contained[m.group(1)])
+        for k in hits:
+            index[k].append(path)
+    return index
+
+
+# カタカナ -> ひらがな（表記ゆれを吸収して突き合わせるため）
+_KATAKANA_TO_HIRAGANA = {c: c - 0x60 for c in range(ord("ァ"), ord("ヶ") + 1)}
+
 
-    structure = {base.name: tree(base)}
-    return yaml.safe_dump(structure, sort_keys=False, allow_unicode=True)
+def normalize_for_match(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).lower().translate(_KATAKANA_TO_HIRAGANA)
 
 
-def list_all_files(src_dir: str) -> list[str]:
-    files = []
-    for root, dirs, filenames in os.walk(src_dir):
-        for fn in filenames:
-            rel = os.path.join(root, fn)
-            files.append(rel.replace("\\", "/"))
-    return files
+def concept_keywords(concept: str) -> set[str]:
+    words = {w for w in re.split(r"[\s\-_/・、,]+", normalize_for_match(concept)) if len(w) >= 2}
+    joined = normalize_for_match(fallback_key(concept))
+    if len(joined) >= 2:
+        words.add(joined)
+    return words
+
+
+# 部分木でも常に残す浅い階層（全体の見取り図として）
+SUBTREE_ORIENTATION_DEPTH = 2
+
+
+def build_concept_subtree(entries: list[TreeEntry], concept: str) -> str:
+    """パスが概念のキーワードを含むエントリとその祖先、および浅い階層のディレクトリだけを残した YAML。
+    キーワードに当たるものが無ければ空文字列を返す。
+    """
+    keywords = concept_keywords(concept)
+    if not keywords:
+        return ""
+    keep: set[int] = set()
+    ancestors: list[int] = []  # 深さ d の祖先の添字が ancestors[d] に入る
+    for i, (depth, _, path, is_dir) in enumerate(entries):
+        del ancestors[depth:]
+        if any(k in normalize_for_match(path) for k in keywords):
+            keep.update(ancestors)
+            keep.add(i)
+        if is_dir:
+            ancestors.append(i)
+    if not keep:
+        return ""
+    subset = [e for i, e in enumerate(entries) if i in keep or (e[3] and e[0] <= SUBTREE_ORIENTATION_DEPTH)]
+    return render_structure_yaml(subset)
+
+
+def classify(path: str) -> str | None:
+    """コードファイルならコードブロックの言語名を、対象外なら None を返す"""
+    return EXT_TO_LANG.get(os.path.splitext(path)[1].lower())
 
 
 def is_code_file(path: str) -> bool:
-    ext = os.path.splitext(path)[1].lower()
-    return ext in ALLOWED_CODE_EXTS
+    # splitext と同じく先頭のドットは拡張子とみなさない（".env" 単体はコードではない）
+    return path.rpartition("/")[2].lstrip(".").lower().endswith(CODE_SUFFIXES)
 
 
 def exclude_dev_asset(path: str) -> bool:
     return bool(EXCLUDE_RE.search(path))
 
 
-def ext_to_lang(ext: str) -> str:
-    return {
-        ".ts": "ts", ".tsx": "tsx", ".js": "js", ".jsx": "jsx", ".mjs": "js", ".cjs": "js",
-        ".py": "python", ".rb": "ruby", ".go": "go", ".rs": "rust", ".java": "java",
-        ".kt": "kotlin", ".kts": "kotlin", ".scala": "scala", ".php": "php", ".cs": "csharp",
-        ".cpp": "cpp", ".c": "c", ".hpp": "cpp", ".h": "c", ".swift": "swift", ".sql": "sql",
-        ".json": "json", ".yml": "yaml", ".yaml": "yaml", ".toml": "toml", ".ini": "ini", ".env": "bash",
-    }.get(ext.lower(), "")
+def exclude_dev_dir(name: str, path: str) -> bool:
+    return name.lower() in EXCLUDE_DIR_NAMES or exclude_dev_asset(path)
+
+
+def accept(path: str) -> bool:
+    """related_codes に含めてよいファイルか（src 配下・開発補助資産でない・コード・実在）"""
+    return (
+        path.startswith(f"{SRC_DIR}/")
+        and not exclude_dev_asset(path)
+        and is_code_file(path)
+        and os.path.exists(path)
+    )
+
 
 # -------------- OpenAI 呼び出し --------------
 
-def call_chat(model: str, system_prompt: str, user_prompt: str, temperature: float = 0.2, max_tokens: int | None = None) -> str:
-    url = f"{OAI_BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+BATCH_TERMINAL_STATUS = {"completed", "failed", "expired", "cancelled"}
+
+
+class IncompleteStreamError(Exception):
+    """ストリーミング応答が [DONE] まで届かなかった、または途中で error イベントが来た（再試行の対象）"""
+
+
+def response_cache_path(payload: dict) -> str | None:
+    """payload に対応するキャッシュファイルのパス。キャッシュ対象外なら None"""
+    if not CACHE_ENABLED or payload.get("temperature", 0) > CACHE_MAX_TEMPERATURE:
+        return None
+    keyed = {"cache_version": CACHE_VERSION, **payload}
+    key = hashlib.sha256(orjson.dumps(keyed, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def read_cached_response(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class AsyncRateLimiter:
+    """リクエスト数とトークン数の 2 つのバケットで RPM / TPM を守るトークンバケット。
+    バケットは取得のたびに経過時間ぶん補充する。
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_capacity = rpm
+        self.token_capacity = tpm
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self.request_capacity = min(self.rpm, self.request_capacity + elapsed * self.rpm / 60)
+        self.token_capacity = min(self.tpm, self.token_capacity + elapsed * self.tpm / 60)
+
+    async def acquire(self, estimated_tokens: int):
+        # 見積もりがバケット容量を超えると永久に待つため、容量で頭打ちにする
+        tokens = min(estimated_tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.request_capacity >= 1 and self.token_capacity >= tokens:
+                    self.request_capacity -= 1
+                    self.token_capacity -= tokens
+                    return
+                wait = max(
+                    (1 - self.request_capacity) * 60 / self.rpm,
+                    (tokens - self.token_capacity) * 60 / self.tpm,
+                )
+                await asyncio.sleep(wait)
+
+
+# 概念を並行処理するため、API 呼び出しの同時実行数と流量をここで一括して絞る
+_API_SEMAPHORE = asyncio.Semaphore(OAI_CONCURRENCY)
+_RATE_LIMITER = AsyncRateLimiter(OAI_RPM, OAI_TPM)
+
+
+def create_client() -> httpx.AsyncClient:
+    """OpenAI 用の HTTP クライアント。HTTP/2 と keep-alive で接続を使い回し、TLS ハンドシェイクを 1 回にする"""
+    return httpx.AsyncClient(
+        base_url=OAI_BASE_URL,
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        http2=True,
+        timeout=120,
+        limits=httpx.Limits(max_connections=OAI_CONCURRENCY, max_keepalive_connections=OAI_CONCURRENCY),
+    )
+
+
+def build_chat_payload(model: str, system_prompt: str, user_prompt: str | list[str], temperature: float = 0.2, max_tokens: int | None = None, prompt_cache_key: str | None = None, response_format: dict | None = None) -> dict:
+    """chat completions のリクエストボディを組み立てる（通常呼び出しと Batch API で共通）。
+    user_prompt をリストで渡すと、巨大な入力を 1 つの文字列に連結せずに別々の user メッセージとして送る。
+    """
+    parts = [user_prompt] if isinstance(user_prompt, str) else user_prompt
     payload = {
         "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
+        "messages": [{"role": "system", "content": system_prompt}] + [{"role": "user", "content": part} for part in parts],
         "temperature": temperature,
     }
     if max_tokens:
         payload["max_tokens"] = max_tokens
+    if prompt_cache_key:
+        payload["prompt_cache_key"] = prompt_cache_key
+    if response_format:
+        payload["response_format"] = response_format
+    return payload
+
+
+def write_cached_response(cache_path: str, content: str) -> None:
+    key = os.path.splitext(os.path.basename(cache_path))[0]
+    write_file(cache_path, orjson.dumps({"payload_hash": key, "response": content}))
 
-    resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=120)
+
+async def read_chat_content(resp: httpx.Response) -> str:
+    """chat completions の応答から本文を取り出す。ストリーミング (SSE) の場合は届いた差分から順に連結する"""
+    if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+        data = orjson.loads(await resp.aread())
+        try:
+            return data["choices"][0]["message"]["content"].strip()
+        except Exception:
+            print("[ERROR] Unexpected OpenAI response:", data, file=sys.stderr)
+            raise
+    pieces = []
+    async for line in resp.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return "".join(pieces).strip()
+        event = orjson.loads(data)
+        if event.get("error"):
+            raise IncompleteStreamError(f"error event: {event['error']}")
+        for choice in event.get("choices") or []:
+            pieces.append((choice.get("delta") or {}).get("content") or "")
+    # 途中で切れた応答をキャッシュに残さないよう、[DONE] が無ければ失敗として扱う
+    raise IncompleteStreamError("stream ended without [DONE]")
+
+
+async def call_chat(client: httpx.AsyncClient, model: str, system_prompt: str, user_prompt: str | list[str], temperature: float = 0.2, max_tokens: int | None = None, prompt_cache_key: str | None = None, response_format: dict | None = None) -> str:
+    payload = build_chat_payload(model, system_prompt, user_prompt, temperature, max_tokens, prompt_cache_key, response_format)
+    return await chat_completion(client, payload)
+
+
+async def chat_completion(client: httpx.AsyncClient, payload: dict) -> str:
+    """build_chat_payload で作ったリクエストを送り、応答本文を返す（応答キャッシュ・流量制御・再試行込み）"""
+    cache_path = response_cache_path(payload)
+    if cache_path:
+        cached = read_cached_response(cache_path)
+        if cached is not None:
+            return cached
+
+    # 圧縮判定で数えた結果がメモ化されているので、多くの場合は再エンコードせずに済む
+    estimated_tokens = sum(count_tokens_batch([m["content"] for m in payload["messages"]])) + payload.get("max_tokens", 0)
+    # stream はキャッシュキーに含めない（応答の受け取り方が違うだけで内容は同じ）
+    body = orjson.dumps({**payload, "stream": True} if STREAM_ENABLED else payload)
+
+    for attempt in range(OAI_MAX_ATTEMPTS):
+        await _RATE_LIMITER.acquire(estimated_tokens)
+        try:
+            async with _API_SEMAPHORE:
+                async with client.stream("POST", "/chat/completions", content=body, headers={"Content-Type": "application/json"}) as resp:
+                    if resp.status_code == 200:
+                        content = await read_chat_content(resp)
+                    else:
+                        await resp.aread()
+        except (httpx.TransportError, IncompleteStreamError) as e:
+            if attempt + 1 >= OAI_MAX_ATTEMPTS:
+                raise
+            reason = repr(e)
+        else:
+            if resp.status_code == 200:
+                break
+            if resp.status_code not in RETRYABLE_STATUS or attempt + 1 >= OAI_MAX_ATTEMPTS:
+                print("[ERROR] OpenAI API error:", resp.status_code, resp.text, file=sys.stderr)
+                raise RuntimeError("OpenAI API error")
+            reason = str(resp.status_code)
+        delay = min(2 ** attempt + random.random(), 60)
+        print(f"[WARN] OpenAI API の呼び出しに失敗しました ({reason})。{delay:.1f} 秒後に再試行します。", file=sys.stderr)
+        await asyncio.sleep(delay)
+
+    # 空の応答はキャッシュしない（次回の実行で取り直す）
+    if cache_path and content:
+        write_cached_response(cache_path, content)
+    return content
+
+
+def _check_response(resp: httpx.Response, what: str) -> dict:
     if resp.status_code != 200:
-        print("[ERROR] OpenAI API error:", resp.status_code, resp.text, file=sys.stderr)
+        print(f"[ERROR] OpenAI API error ({what}):", resp.status_code, resp.text, file=sys.stderr)
         raise RuntimeError("OpenAI API error")
-    data = resp.json()
-    try:
-        return data["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        print("[ERROR] Unexpected OpenAI response:", data, file=sys.stderr)
-        raise
+    return orjson.loads(resp.content)
+
+
+async def run_batch(client: httpx.AsyncClient, requests: dict[str, dict]) -> dict[str, str]:
+    """Batch API に chat completions をまとめて投入し、完了まで待って {custom_id: 応答本文} を返す
+
+    失敗した・期限切れで結果が無いリクエストは含まれない（呼び出し側で通常の呼び出しにフォールバックする）
+    """
+    lines = b"".join(
+        orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + b"\n"
+        for custom_id, body in requests.items()
+    )
+    resp = await client.post("/files", files={"file": ("batch.jsonl", lines, "application/jsonl")}, data={"purpose": "batch"})
+    input_file_id = _check_response(resp, "files.create")["id"]
+
+    resp = await client.post(
+        "/batches",
+        content=orjson.dumps({"input_file_id": input_file_id, "endpoint": "/v1/chat/completions", "completion_window": "24h"}),
+        headers={"Content-Type": "application/json"},
+    )
+    batch = _check_response(resp, "batches.create")
+    print(f"[INFO] Batch {batch['id']} を作成しました ({len(requests)} 件)。完了を待ちます。")
+
+    while batch.get("status") not in BATCH_TERMINAL_STATUS:
+        await asyncio.sleep(OAI_BATCH_POLL_SECONDS)
+        resp = await client.get(f"/batches/{batch['id']}")
+        batch = _check_response(resp, "batches.retrieve")
+        counts = batch.get("request_counts") or {}
+        print(f"[INFO] Batch {batch['id']}: {batch.get('status')} ({counts.get('completed', 0)}/{counts.get('total', len(requests))})")
+
+    if batch.get("status") != "completed":
+        print(f"[WARN] Batch {batch['id']} が {batch.get('status')} で終了しました。", file=sys.stderr)
+    if not batch.get("output_file_id"):
+        return {}
+
+    resp = await client.get(f"/files/{batch['output_file_id']}/content")
+    if resp.status_code != 200:
+        _check_response(resp, "files.content")
+    outputs = {}
+    for line in resp.content.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        try:
+            outputs[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError):
+            print("[WARN] Unexpected batch output:", item, file=sys.stderr)
+    return outputs
+
+
+async def chat_completions_batch(client: httpx.AsyncClient, payloads: list[dict]) -> list[str]:
+    """複数のリクエストを 1 つの Batch にまとめて実行し、応答本文を入力順に返す。
+    応答キャッシュに当たるものは投入せず、Batch で結果が得られなかったものは通常の呼び出しで補う。
+    """
+    results: list[str | None] = [None] * len(payloads)
+    pending: dict[str, int] = {}
+    for i, payload in enumerate(payloads):
+        cache_path = response_cache_path(payload)
+        cached = read_cached_response(cache_path) if cache_path else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending[f"req-{i}"] = i
+
+    outputs = await run_batch(client, {custom_id: payloads[i] for custom_id, i in pending.items()}) if pending else {}
+
+    async def resolve(custom_id: str, i: int):
+        content = outputs.get(custom_id)
+        if content is None:
+            print(f"[WARN] Batch で {custom_id} の結果が得られませんでした。通常の呼び出しで補います。", file=sys.stderr)
+            content = await chat_completion(client, payloads[i])
+        else:
+            cache_path = response_cache_path(payloads[i])
+            if cache_path and content:
+                write_cached_response(cache_path, content)
+        results[i] = content
+
+    await asyncio.gather(*(resolve(custom_id, i) for custom_id, i in pending.items()))
+    return t.cast("list[str]", results)
+
+
+_JSON_DECODER = json.JSONDecoder()
 
 
 def extract_json_array(text: str) -> list[str]:
-    """レスポンステキストから最初の JSON 配列を抽出してパース"""
-    m = re.search(r"\[.*\]", text, flags=re.S)
-    if not m:
-        return []
-    raw = m.group(0)
-    try:
-        arr = json.loads(raw)
-        if isinstance(arr, list):
-            return [str(x) for x in arr]
-    except Exception:
-        pass
+    """レスポンステキストから最初の JSON 配列を抽出してパース。
+    説明文中の "[" で失敗した場合は次の "[" から読み直す。
+    """
+    start = text.find("[")
+    while start != -1:
+        try:
+            arr, _ = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            pass
+        else:
+            if isinstance(arr, list):
+                return [str(x) for x in arr]
+        start = text.find("[", start + 1)
     return []
 
+
+def parse_file_list(text: str) -> list[str]:
+    """ファイル抽出の応答 {"files": [...]} からパス一覧を取り出す。
+    JSON モードを使わない場合や形が崩れている場合は、最初の JSON 配列を拾う。
+    """
+    if JSON_MODE:
+        try:
+            data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get("files"), list):
+            return [str(x) for x in data["files"]]
+    return extract_json_array(text)
+
 # -------------- プロンプト --------------
+# OpenAI の自動プロンプトキャッシュは先頭一致で効くため、
+# ユーザープロンプトは実行中に不変な部分を先頭に、概念ごとに変わる部分を末尾に置く。
 
 FILE_PICKER_SYSTEM = (
     """
@@ -188,7 +661,7 @@ FILE_PICKER_SYSTEM = (
 - 「実装」: ユースケース/サービス、ハンドラ/コントローラ、ルータ、リポジトリ/ゲートウェイ、DTO/シリアライザ/変換、アプリケーションフロー
 
 【必須ルール】
-1) 出力は **JSON 配列（相対パス文字列）** のみ。説明文禁止。
+1) 出力は **`{"files": [...]}` 形式の JSON オブジェクト**（files は相対パス文字列の配列）のみ。説明文禁止。
 2) 対象は **`src/` 配下のみ**。
 3) **対象ディレクトリを選んだ場合、配下を再帰的に展開し「ファイル単位」で列挙**すること。
    - 例: `src/endpoints/tag/list/` を選ぶなら、その直下およびサブディレクトリの **全てのソースファイル** を出力。中継ファイル（例: `index.*`）だけで止めない。
@@ -212,26 +685,32 @@ FILE_PICKER_SYSTEM = (
 - ② 候補ディレクトリは **必ず再帰展開** して配下のファイルをすべて取得（入口ファイルだけに限定しない）。
 - ③ 仕様ファイル（上記 5)）を該当領域から拾う（`endpoints/.../openapi.yaml` など）。概念に紐づく場所にあれば必ず含める。
 - ④ 汎用ユーティリティを除外。ただし概念固有のルール/変換/スキーマに直接関与していれば含める。
-- ⑤ 除外ルールを適用し、最終的な **ファイルパス JSON 配列** を返す。
+- ⑤ 除外ルールを適用し、最終的な **ファイルパス配列を files に入れた JSON オブジェクト** を返す。
 
 【出力形式】
-["src/feature/a.ts", "src/feature/b.ts", "src/endpoints/tag/list/handler.ts", "..."]
+{"files": ["src/feature/a.ts", "src/feature/b.ts", "src/endpoints/tag/list/handler.ts", "..."]}
 """
 ).strip()
 
-FILE_PICKER_USER_TMPL = (
+# structure は先頭メッセージ、概念名は別メッセージとして送る。
+# 概念名に一致する部分木があれば全体の代わりにそれを送り、無ければ全体を送る（全体を送る概念同士は先頭一致でプロンプトキャッシュが効く）
+FILE_PICKER_STRUCTURE_TMPL = (
     """
-# 概念
-{concept}
-
-# structure (srcツリーの完全YAML)
+# structure ({scope})
 {structure}
 
 # 期待する出力形式
-["src/feature/a.ts", "src/feature/b.tsx"]
+{{"files": ["src/feature/a.ts", "src/feature/b.tsx"]}}
 """
 ).strip()
 
+FILE_PICKER_SCOPE_FULL = "srcツリー全体のYAML。開発補助資産は除外済み"
+FILE_PICKER_SCOPE_SUBTREE = "srcツリーから概念名に一致するパスとその祖先、浅い階層のディレクトリだけを抜き出したYAML"
+
+FILE_PICKER_CONCEPT_TMPL = """# 概念
+{concept}"""
+
+DOC_WRITER_TEMPERATURE = 0.25
 DOC_WRITER_SYSTEM = (
     """
 あなたは、非エンジニアも読者に含むプロダクト向けテクニカルライターです。与えられた `related_codes` と `概念`、および `USED_PATHS` と `REPO_BASE_URL` から、
@@ -258,20 +737,24 @@ DOC_WRITER_SYSTEM = (
 """
 ).strip()
 
+# related_codes は書式化せず、この見出しの直後に単独のメッセージとして送る
+DOC_WRITER_CONTEXT_TMPL = (
+    """
+# REPO_BASE_URL（GitHub 上のベース URL。末尾に相対パスを連結して使う）
+{repo_base_url}
+
+# related_codes（次のメッセージ。ファイルごとにラベル済み）
+"""
+).strip()
+
 DOC_WRITER_USER_TMPL = (
     """
 # 概念
 {concept}
 
-# related_codes（ファイルごとにラベル済み）
-{related_codes}
-
 # USED_PATHS（関連ファイルの相対パス、漏れなくすべて）
 {used_paths}
 
-# REPO_BASE_URL（GitHub 上のベース URL。末尾に相対パスを連結して使う）
-{repo_base_url}
-
 # 期待する Markdown セクション例
 # {title}
 > ※最初に 1〜3 行でこの概念の平易な説明を書いてください。
@@ -301,82 +784,208 @@ COMPRESSOR_SYSTEM = (
 
 # -------------- 主要処理 --------------
 
+def default_context_budget() -> int:
+    """MAX_CONTEXT_TOKENS 未指定時の related_codes の上限。
+    ドキュメント生成モデルのコンテキスト長（TPM 上限の方が小さければそちら）から、
+    固定部分のプロンプトと出力の最大長を引き、見積もり誤差に備えて 5% 残す。
+    """
+    prefix = max((k for k in MODEL_LIMITS if MODEL_DOCS.startswith(k)), key=len, default=None)
+    window, max_output = MODEL_LIMITS[prefix] if prefix else DEFAULT_MODEL_LIMITS
+    fixed = sum(count_tokens_batch([DOC_WRITER_SYSTEM, DOC_WRITER_CONTEXT_TMPL, DOC_WRITER_USER_TMPL]))
+    return max(int((min(window, OAI_TPM) - fixed - max_output) * 0.95), 1000)
+
+
 def ensure_output_dirs():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     os.makedirs(os.path.join(OUTPUT_DIR, "src"), exist_ok=True)
 
 
-def write_file(path: str, content: str):
+def write_file(path: str, content: str | bytes):
+    """一時ファイルに書いてから置き換える（途中で失敗しても書きかけのファイルを残さない）"""
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
+    # 文字列は 1 回だけ UTF-8 にして、テキスト層を通さずにそのまま書く（改行も変換しない）
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    # 並行して同じパスに書く場合に備えて、一時ファイル名はスレッドごとに分ける
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+async def write_files(writes: list[tuple[str, str | bytes]]):
+    await asyncio.gather(*(asyncio.to_thread(write_file, path, content) for path, content in writes))
+
+
+# パス -> (st_mtime_ns, 本文)。複数の概念が同じファイルを参照しても読み込みは 1 回で済ませる
+_FILE_CACHE: dict[str, tuple[int, str | None]] = {}
+
+
+def read_code(path: str) -> str | None:
+    """ファイル内容を返す。読めないファイルと中身の無いファイルは None（related_codes に含めない）"""
+    try:
+        st = os.stat(path)
+        # 空ファイルは開かずに除外する
+        if st.st_size == 0:
+            return None
+        cached = _FILE_CACHE.get(path)
+        if cached and cached[0] == st.st_mtime_ns:
+            return cached[1]
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            code = f.read()
+    except Exception:
+        return None
+    if not code.strip():
+        code = None
+    _FILE_CACHE[path] = (st.st_mtime_ns, code)
+    return code
 
 
-def build_related_codes(paths: list[str]) -> tuple[str, list[str]]:
-    """ファイルを読み込み、LLM に渡しやすい形へ整形。
+async def build_related_codes(paths: list[str]) -> tuple[str, list[str]]:
+    """ファイルを読み込み、LLM に渡しやすい形へ整形。paths は accept() で絞り込み済みであること。
     returns: (related_codes_text, used_paths)
     """
-    blocks = []
-    used = []
-    total_len = 0
-
-    for p in paths:
-        if not os.path.exists(p):
-            continue
-        if exclude_dev_asset(p):
+    # 読み込みはスレッドで並行に行い、整形は入力順に行う
+    codes = await asyncio.gather(*(asyncio.to_thread(read_code, p) for p in paths))
+
+    # 生成コードやコピーされたファイルなど、内容が同一のファイルは本文を最初の 1 つにだけ載せ、残りは 1 行で参照する
+    seen: dict[bytes, str] = {}
+    blocks = []  # (パス, ヘッダ, 本文, 末尾)
+    for p, code in zip(paths, codes):
+        if code is None:
             continue
-        if not is_code_file(p):
+        digest = hashlib.blake2b(code.encode("utf-8", errors="replace"), digest_size=16).digest()
+        if digest in seen:
+            blocks.append((p, f"===== file: {p} =====\n", f"(identical to {seen[digest]})", "\n"))
             continue
-        ext = os.path.splitext(p)[1]
-        lang = ext_to_lang(ext)
-        try:
-            with open(p, "r", encoding="utf-8", errors="replace") as f:
-                code = f.read()
-        except Exception:
-            continue
-        header = f"===== file: {p} ====="
-        chunk = f"{header}\n```{lang}\n{code}\n```\n"
-        blocks.append(chunk)
+        seen[digest] = p
+        blocks.append((p, f"===== file: {p} =====\n```{classify(p)}\n", code, "\n```\n"))
+    # トークン数はヘッダと本文をまとめて 1 回で数える（内容ごとにキャッシュされるので、概念をまたいでも数え直さない）
+    counts = count_tokens_batch([text for _, header, body, _ in blocks for text in (header, body)])
+
+    # ファイルごとの中間文字列を作らず、1 つのバッファに直接書き込む
+    buf = io.StringIO()
+    used = []
+    total_tokens = 0
+
+    for i, (p, header, body, footer) in enumerate(blocks):
+        if used:
+            buf.write("\n\n")
+        buf.write(header)
+        buf.write(body)
+        buf.write(footer)
         used.append(p)
-        total_len += len(chunk)
-        if total_len > MAX_CONTEXT_CHARS:
+        total_tokens += counts[2 * i] + counts[2 * i + 1]
+        if total_tokens > MAX_CONTEXT_TOKENS:
             break
 
-    related = "\n\n".join(blocks)
-    return related, used
-
-
-def compress_if_needed(related: str, concept: str) -> str:
-    if len(related) <= MAX_CONTEXT_CHARS:
-        return related
-    # 文字数超過時は分割し、要点に圧縮
-    parts = []
-    idx = 0
-    step = MAX_CONTEXT_CHARS // 2
-    while idx < len(related) and len(parts) < 6:  # 安全のため分割上限
-        chunk = related[idx: idx + step]
-        idx += step
-        uprompt = f"# 概念\n{concept}\n\n# コード断片\n{chunk}"
-        summary = call_chat(MODEL_DOCS, COMPRESSOR_SYSTEM, uprompt, temperature=0.1)
-        parts.append(summary)
-        time.sleep(0.6)
-    merged = "\n".join(parts)
-    return f"<!-- compressed from large related_codes -->\n{merged}"
-
-
-def generate_markdown(concept: str, related_codes_text: str, used_paths: list[str]) -> str:
-    title = f"{concept}"
-    repo_base = os.environ.get("REPO_BASE_URL", "https://github.com/netmateapp/netmate-api/tree/main/")
+    return buf.getvalue(), used
+
+
+# build_related_codes が書き出すファイルブロックの境目
+_FILE_BLOCK_SPLIT_RE = re.compile(r"\n\n(?====== file: )")
+
+
+def pack_blocks(blocks: list[str], capacity: int) -> list[str]:
+    """ファイルごとのブロックを first-fit decreasing で capacity トークン以下のチャンクに詰める。
+    1 つで capacity を超えるブロックはトークン列で分割する。チャンク内・チャンク間は元の順序に並べ直す。
+    """
+    enc = get_encoder()
+    # (トークン数, 元の位置, 本文)。分割した断片は元の位置の後ろに番号を足して順序を保つ
+    items: list[tuple[int, tuple[int, int], str]] = []
+    for i, (block, n) in enumerate(zip(blocks, count_tokens_batch(blocks))):
+        if n <= capacity:
+            items.append((n, (i, 0), block))
+            continue
+        ids = enc.encode_ordinary(block)
+        for j in range(0, len(ids), capacity):
+            piece = ids[j: j + capacity]
+            items.append((len(piece), (i, j), enc.decode(piece)))
+
+    items.sort(key=lambda item: item[0], reverse=True)
+    remaining: list[int] = []
+    bins: list[list[tuple[tuple[int, int], str]]] = []
+    for n, pos, text in items:
+        for b, room in enumerate(remaining):
+            if n <= room:
+                remaining[b] -= n
+                bins[b].append((pos, text))
+                break
+        else:
+            remaining.append(capacity - n)
+            bins.append([(pos, text)])
+
+    for b in bins:
+        b.sort(key=lambda entry: entry[0])
+    bins.sort(key=lambda b: b[0][0])
+    return ["\n\n".join(text for _, text in b) for b in bins]
+
+
+async def compress_many(client: httpx.AsyncClient, items: list[tuple[str, str]], batch: bool = False) -> list[str]:
+    """(概念, related_codes) ごとに、MAX_CONTEXT_TOKENS を超えるものを要点に圧縮して返す。
+    batch=True なら各段の要約を全概念ぶんまとめて 1 つの Batch で実行する。
+    """
+    results = [related for _, related in items]
+    # 圧縮が必要なもの: 位置 -> 次の段で要約するブロック（最初はファイル単位）
+    todo = {i: _FILE_BLOCK_SPLIT_RE.split(related) for i, (_, related) in enumerate(items) if count_tokens(related) > MAX_CONTEXT_TOKENS}
+    label = "コード断片"
+    for _ in range(COMPRESS_MAX_ROUNDS):
+        if not todo:
+            break
+        jobs = [(i, chunk) for i, blocks in todo.items() for chunk in pack_blocks(blocks, MAX_CONTEXT_TOKENS // 2)[:6]]  # 安全のため分割上限
+        payloads = [
+            build_chat_payload(MODEL_DOCS, COMPRESSOR_SYSTEM, f"# 概念\n{items[i][0]}\n\n# {label}\n{chunk}", temperature=0.1)
+            for i, chunk in jobs
+        ]
+        if batch:
+            parts = await chat_completions_batch(client, payloads)
+        else:
+            # 断片ごとの圧縮は独立しているので一斉に投げる（流量は chat_completion 側で絞る）
+            parts = await asyncio.gather(*(chat_completion(client, payload) for payload in payloads))
+
+        summaries: dict[int, list[str]] = {}
+        for (i, _), part in zip(jobs, parts):
+            summaries.setdefault(i, []).append(part)
+        todo = {}
+        for i, ps in summaries.items():
+            merged = "\n".join(ps)
+            results[i] = f"<!-- compressed from large related_codes -->\n{merged}"
+            # 要約を連結してもまだ大きい場合は、要約同士をさらに要約する
+            if count_tokens(merged) > MAX_CONTEXT_TOKENS:
+                todo[i] = ps
+        label = "要約断片"
+    return results
+
+
+async def compress_if_needed(client: httpx.AsyncClient, related: str, concept: str) -> str:
+    return (await compress_many(client, [(concept, related)]))[0]
+
+
+def report_duplicate_evidence(related_hashes: list[tuple[str, str]]):
+    """related_codes が同一になった概念を警告する"""
+    groups: dict[str, list[str]] = {}
+    for concept, h in related_hashes:
+        groups.setdefault(h, []).append(concept)
+    for concepts in groups.values():
+        if len(concepts) > 1:
+            print(f"[WARN] 概念 {', '.join(concepts)} の related_codes が同一です。concepts.yaml の重複を確認してください。")
+
+
+def doc_writer_prompt(concept: str, related_codes_text: str, used_paths: list[str]) -> list[str]:
     used_paths_md = "\n".join([f"- {p}" for p in used_paths]) if used_paths else "- (なし)"
+    return [
+        DOC_WRITER_CONTEXT_TMPL.format(repo_base_url=REPO_BASE_URL),
+        related_codes_text,
+        DOC_WRITER_USER_TMPL.format(concept=concept, used_paths=used_paths_md, title=concept),
+    ]
 
-    uprompt = DOC_WRITER_USER_TMPL.format(
-        concept=concept,
-        related_codes=related_codes_text,
-        used_paths=used_paths_md,
-        repo_base_url=repo_base,
-        title=title,
-    )
-    md = call_chat(MODEL_DOCS, DOC_WRITER_SYSTEM, uprompt, temperature=0.25)
+
+def finalize_markdown(md: str, used_paths: list[str]) -> str:
+    repo_base = REPO_BASE_URL
 
     # セーフティ: 関連ファイルを必ず完全列挙（GitHub リンク付き）
     if "## 関連ファイル" not in md:
@@ -395,7 +1004,64 @@ def generate_markdown(concept: str, related_codes_text: str, used_paths: list[st
     return md
 
 
-def ensure_mdbook_scaffold(domain: str, concept_files: list[tuple[str, str]]):
+async def generate_markdown(client: httpx.AsyncClient, concept: str, related_codes_text: str, used_paths: list[str]) -> str:
+    uprompt = doc_writer_prompt(concept, related_codes_text, used_paths)
+    md = await call_chat(client, MODEL_DOCS, DOC_WRITER_SYSTEM, uprompt, temperature=DOC_WRITER_TEMPERATURE)
+    return finalize_markdown(md, used_paths)
+
+
+async def generate_markdown_batch(client: httpx.AsyncClient, evidences: list[tuple[str, str, list[str]]]) -> list[str]:
+    """(概念, related_codes, 使用パス) の一覧からドキュメントを Batch API でまとめて生成する"""
+    contents = await chat_completions_batch(client, [
+        build_chat_payload(MODEL_DOCS, DOC_WRITER_SYSTEM, doc_writer_prompt(*evidence), temperature=DOC_WRITER_TEMPERATURE)
+        for evidence in evidences
+    ])
+    return [finalize_markdown(content, used_paths) for content, (_, _, used_paths) in zip(contents, evidences)]
+
+
+# index.md に埋め込む、生成時の入力のハッシュ
+_SIGNATURE_RE = re.compile(r"<!-- source-signature: ([0-9a-f]+) -->")
+
+
+def source_signature(tree: list[TreeEntry], domain: str, concepts: list[str]) -> str:
+    """生成結果を左右する入力（src のパスと内容・概念リスト・このスクリプト・設定）のハッシュ"""
+    h = hashlib.blake2b(digest_size=32)
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(orjson.dumps([CACHE_VERSION, MODEL_FILES, MODEL_DOCS, REPO_BASE_URL, MAX_CONTEXT_TOKENS, JSON_MODE, SRC_DIR, domain, concepts]))
+    for _, _, path, is_dir in tree:
+        h.update(path.encode("utf-8", errors="replace") + b"\0")
+        if is_dir:
+            continue
+        # リンク切れや読めないファイルで全体を止めない。FIFO などは開くと待ち続けるので中身を読まない
+        try:
+            if not stat.S_ISREG(os.stat(path).st_mode):
+                h.update(b"<not-a-regular-file>")
+                continue
+            with open(path, "rb") as f:
+                h.update(hashlib.blake2b(f.read(), digest_size=16).digest())
+        except OSError:
+            h.update(b"<unreadable>")
+    return h.hexdigest()
+
+
+def is_up_to_date(signature: str, concepts: list[str]) -> bool:
+    """前回の生成と入力が同じで、出力もすべて揃っているか"""
+    src_out = os.path.join(OUTPUT_DIR, "src")
+    try:
+        with open(os.path.join(src_out, "index.md"), "r", encoding="utf-8") as f:
+            m = _SIGNATURE_RE.search(f.read())
+    except OSError:
+        return False
+    if not m or m.group(1) != signature:
+        return False
+    expected = ["SUMMARY.md"] + [f"{slugify(c)}.md" for c in concepts]
+    return all(os.path.exists(os.path.join(src_out, name)) for name in expected)
+
+
+def mdbook_scaffold_files(domain: str, concept_files: list[tuple[str, str]], signature: str = "") -> list[tuple[str, str]]:
+    """mdBook の index / book.toml / SUMMARY を (パス, 内容) の一覧として返す"""
+    writes = []
     # index
     index_md = textwrap.dedent(f"""
     # {domain or 'プロダクトドキュメント'}
@@ -423,7 +1089,9 @@ def ensure_mdbook_scaffold(domain: str, concept_files: list[tuple[str, str]]):
 
     *このドキュメントは継続的に改善されています。フィードバックや改善提案があれば、お気軽にお知らせください。*
     """)
-    write_file(os.path.join(OUTPUT_DIR, "src", "index.md"), index_md)
+    if signature:
+        index_md += f"\n<!-- source-signature: {signature} -->\n"
+    writes.append((os.path.join(OUTPUT_DIR, "src", "index.md"), index_md))
 
     # book.toml（無ければ作成）
     book_toml_path = os.path.join(OUTPUT_DIR, "book.toml")
@@ -439,83 +1107,131 @@ def ensure_mdbook_scaffold(domain: str, concept_files: list[tuple[str, str]]):
             create-missing = true
             """
         )
-        write_file(book_toml_path, book_toml)
+        writes.append((book_toml_path, book_toml))
 
     # SUMMARY.md
     lines = ["# Summary", "", "- [トップ](index.md)"]
     for title, filename in concept_files:
         lines.append(f"- [{title}]({filename})")
-    write_file(os.path.join(OUTPUT_DIR, "src", "SUMMARY.md"), "\n".join(lines))
+    writes.append((os.path.join(OUTPUT_DIR, "src", "SUMMARY.md"), "\n".join(lines)))
+    return writes
+
+
+async def collect_evidence(client: httpx.AsyncClient, concept: str, tree: list[TreeEntry], structure_yaml: str, fallback_lookup: t.Callable[[str], list[str]]) -> tuple[str, str, list[str]]:
+    """1 つの概念についてファイル抽出から related_codes の作成までを行い、(概念, related_codes, 使用パス) を返す（圧縮前）"""
+    print(f"[INFO] Processing concept: {concept}")
+    subtree = build_concept_subtree(tree, concept)
+    if subtree:
+        structure = FILE_PICKER_STRUCTURE_TMPL.format(scope=FILE_PICKER_SCOPE_SUBTREE, structure=subtree.rstrip())
+    else:
+        structure = FILE_PICKER_STRUCTURE_TMPL.format(scope=FILE_PICKER_SCOPE_FULL, structure=structure_yaml)
+    uprompt = [structure, FILE_PICKER_CONCEPT_TMPL.format(concept=concept)]
+    resp = await call_chat(
+        client, MODEL_FILES, FILE_PICKER_SYSTEM, uprompt, temperature=0.1,
+        prompt_cache_key=hashlib.sha1(structure.encode()).hexdigest()[:16],
+        response_format={"type": "json_object"} if JSON_MODE else None,
+    )
+    candidates = parse_file_list(resp)
+
+    # フォールバック: structure から単純検索（念のため）
+    if not candidates:
+        print(f"[WARN] LLM がファイルを返しませんでした。フォールバック検索を試みます。")
+        candidates = fallback_lookup(concept)
+
+    # フィルタリング（重複は先に除いてから判定する）
+    normalized = dict.fromkeys(p.strip().lstrip("./") for p in candidates)
+    files = [p for p in normalized if accept(p)]
+
+    # 関連コード整形
+    related, used_paths = await build_related_codes(files)
+    if not related:
+        related = "<!-- no related codes found -->"
+    return (concept, related, used_paths)
+
+
+async def process_concept(client: httpx.AsyncClient, concept: str, tree: list[TreeEntry], structure_yaml: str, fallback_lookup: t.Callable[[str], list[str]]) -> tuple[str, str, list[str], str]:
+    """1 つの概念についてファイル抽出からドキュメント生成までを行い、(概念, related_codes, 使用パス, Markdown) を返す"""
+    _, related, used_paths = await collect_evidence(client, concept, tree, structure_yaml, fallback_lookup)
+    related = await compress_if_needed(client, related, concept)
+    md = await generate_markdown(client, concept, related, used_paths)
+    return (concept, related, used_paths, md)
+
 
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="src/ から概念ドキュメントを生成する")
+    parser.add_argument("--no-cache", action="store_true", help="LLM 応答のディスクキャッシュを使わない")
+    parser.add_argument("--batch", action="store_true", help="圧縮とドキュメント生成を Batch API でまとめて行う（夜間実行向け）")
+    return parser.parse_args(argv)
+
+
+async def main():
+    global CACHE_ENABLED, MAX_CONTEXT_TOKENS
+    args = parse_args()
+    if args.no_cache:
+        CACHE_ENABLED = False
+    if MAX_CONTEXT_TOKENS <= 0:
+        MAX_CONTEXT_TOKENS = default_context_budget()
+        print(f"[INFO] MAX_CONTEXT_TOKENS を {MAX_CONTEXT_TOKENS} とします（{MODEL_DOCS} のコンテキスト長から算出）。")
 
-def main():
     ensure_output_dirs()
 
     domain, concepts = read_concepts(CONCEPTS_FILE)
     if not concepts:
         print("[INFO] 概念が無いため処理を終了します。")
         # mdBook scaffold だけ作る
-        ensure_mdbook_scaffold(domain, [])
+        await write_files(mdbook_scaffold_files(domain, []))
         return
 
     # structure を生成
-    structure_yaml = build_structure_yaml(SRC_DIR)
-    write_file(os.path.join(OUTPUT_DIR, "_structure.yaml"), structure_yaml)
-
-    concept_files: list[tuple[str, str]] = []
-
-    for concept in concepts:
-        print(f"[INFO] Processing concept: {concept}")
-        uprompt = FILE_PICKER_USER_TMPL.format(concept=concept, structure=structure_yaml)
-        resp = call_chat(MODEL_FILES, FILE_PICKER_SYSTEM, uprompt, temperature=0.1)
-        candidates = extract_json_array(resp)
-
-        # フォールバック: structure から単純検索（念のため）
-        if not candidates:
-            print(f"[WARN] LLM がファイルを返しませんでした。フォールバック検索を試みます。")
-            all_files = [p for p in list_all_files(SRC_DIR) if p.startswith(f"{SRC_DIR}/")]
-            key = slugify(concept).replace("-", "")
-            candidates = [p for p in all_files if key and key.lower() in p.lower()]
-
-        # フィルタリング
-        files = []
-        for p in candidates:
-            p = p.strip().lstrip("./")
-            if not p.startswith(f"{SRC_DIR}/"):
-                continue
-            if exclude_dev_asset(p):
-                continue
-            if not is_code_file(p):
-                continue
-            if not os.path.exists(p):
-                continue
-            files.append(p)
-        files = list(dict.fromkeys(files))  # de-dup
+    tree = scan_tree(SRC_DIR)
 
-        # 関連コード整形
-        related, used_paths = build_related_codes(files)
-        if not related:
-            related = "<!-- no related codes found -->"
-
-        related = compress_if_needed(related, concept)
-
-        # ドキュメント生成
-        md = generate_markdown(concept, related, used_paths)
-
-        # 保存
-        slug = slugify(concept)
-        out_path = os.path.join(OUTPUT_DIR, "src", f"{slug}.md")
-        write_file(out_path, md)
-        concept_files.append((concept, f"{slug}.md"))
-        time.sleep(0.6)
+    # 入力が前回の生成から何も変わっていなければ LLM を呼ばずに終える
+    signature = source_signature(tree, domain, concepts)
+    if CACHE_ENABLED and is_up_to_date(signature, concepts):
+        print("[INFO] src・概念リスト・設定が前回の生成から変わっていないため、処理を終了します。")
+        return
 
-    # mdBook セットアップ
-    ensure_mdbook_scaffold(domain, concept_files)
+    structure_yaml = render_structure_yaml(tree)
+
+    # フォールバック検索の索引は、最初にフォールバックした概念のところで全概念ぶんを 1 回だけ作る
+    fallback_idx: dict[str, list[str]] | None = None
+
+    def fallback_lookup(concept: str) -> list[str]:
+        nonlocal fallback_idx
+        if fallback_idx is None:
+            fallback_idx = fallback_index(tree, (fallback_key(c) for c in concepts))
+        return fallback_idx.get(fallback_key(concept), [])
+
+    # 概念ごとの処理を並行実行（gather は入力順で結果を返すため SUMMARY の順序は保たれる）
+    async with create_client() as client:
+        if args.batch:
+            # ファイル抽出は後段の入力になるため通常どおり呼び出し、圧縮とドキュメント生成を Batch API に回す
+            evidences = await asyncio.gather(*(collect_evidence(client, c, tree, structure_yaml, fallback_lookup) for c in concepts))
+            compressed = await compress_many(client, [(concept, related) for concept, related, _ in evidences], batch=True)
+            evidences = [(concept, related, used_paths) for (concept, _, used_paths), related in zip(evidences, compressed)]
+            mds = await generate_markdown_batch(client, evidences)
+            results = [(concept, related, used_paths, md) for (concept, related, used_paths), md in zip(evidences, mds)]
+        else:
+            results = await asyncio.gather(*(process_concept(client, c, tree, structure_yaml, fallback_lookup) for c in concepts))
+    # 根拠が見つからなかった概念は共通のプレースホルダになるため、重複の判定から除く
+    report_duplicate_evidence([
+        (concept, hashlib.sha256(related.encode()).hexdigest()) for concept, related, used_paths, _ in results if used_paths
+    ])
+
+    # 保存と mdBook セットアップ（書き込みはすべて揃ってから一括で行う）
+    writes = [(os.path.join(OUTPUT_DIR, "_structure.yaml"), structure_yaml)]
+    concept_files = []
+    for concept, _, _, md in results:
+        filename = f"{slugify(concept)}.md"
+        writes.append((os.path.join(OUTPUT_DIR, "src", filename), md))
+        concept_files.append((concept, filename))
+    writes += mdbook_scaffold_files(domain, concept_files, signature)
+    await write_files(writes)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except Exception as e:
         print("[ERROR] 処理に失敗しました:", e, file=sys.stderr)
         sys.exit(1)